@@ -6,56 +6,74 @@ from sklearn.experimental import enable_halving_search_cv # noqa
 from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.model_selection import GridSearchCV, KFold, train_test_split
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score  
 import warnings
 import time
+import atexit
 from tempfile import mkdtemp
 from shutil import rmtree
-from joblib import Memory
+from joblib import Memory, parallel_backend
+from threadpoolctl import threadpool_limits, threadpool_info
+from numba import njit, prange
 from read_file import read_file
 import pdb
 import numpy as np
-import json
+import orjson
 import os
 import inspect
-from utils import jsonify
 from symbolic_utils import get_sym_model
 
-def evaluate_model(dataset, results_path, random_state, est_name, est, 
-                   hyper_params, complexity, model, test=False, 
-                   target_noise=0.0, feature_noise=0.0, 
-                   n_samples=10000, scale_x = True, scale_y = True,
-                   pre_train=None, skip_tuning=False, sym_data=False):
+# param values worth storing in the results json; one isinstance call with a
+# tuple beats a per-type check loop on every param
+SCALAR_TYPES = (bool, int, float, str)
 
-    print(40*'=','Evaluating '+est_name+' on ',dataset,40*'=',sep='\n')
+@njit(parallel=True, fastmath=True, cache=True)
+def fused_scores(y_pred, y_true, y_mu, y_sc, y_mean):
+    """denormalizes y_pred and accumulates mse, mae and r2 in a single
+    streaming pass instead of separate inverse_transform + metric passes"""
+    ss_res = 0.0
+    abs_err = 0.0
+    ss_tot = 0.0
+    for i in prange(y_pred.size):
+        d = y_pred[i]*y_sc + y_mu - y_true[i]
+        ss_res += d*d
+        abs_err += abs(d)
+        t = y_true[i] - y_mean
+        ss_tot += t*t
+    r2 = 1.0 - ss_res/ss_tot if ss_tot > 0 else 0.0
+    return ss_res/y_pred.size, abs_err/y_pred.size, r2
 
-    np.random.seed(random_state)
-    if hasattr(est, 'random_state'):
-        est.random_state = random_state
+# disk cache for the data setup, keyed on (dataset, seed, ...). repeated runs
+# across algorithms and seeds skip the csv parse, split and scaling;
+# mmap_mode lets joblib workers share the cached arrays read-only.
+memory = Memory(location=os.environ.get('SR_CACHE','/tmp/sr_cache'),
+                mmap_mode='r', verbose=0)
 
-    ##################################################
-    # setup data
-    ##################################################
+@memory.cache
+def setup_data(dataset, random_state, n_samples, scale_x, scale_y):
+    """reads, splits, subsamples and scales the dataset"""
     features, labels, feature_names = read_file(dataset)
-    if sym_data:
-        true_model = get_sym_model(dataset)
     # generate train/test split
     X_train, X_test, y_train, y_test = train_test_split(features, labels,
                                                     train_size=0.75,
                                                     test_size=0.25,
                                                     random_state=random_state)
 
-    # if dataset is large, subsample the training set 
+    # if dataset is large, subsample the training set
     if n_samples > 0 and len(labels) > n_samples:
+        rng = np.random.default_rng(random_state)
+        n_samples = min(n_samples, len(X_train))
         print('subsampling training data from',len(X_train),'to',n_samples)
-        sample_idx = np.random.choice(np.arange(len(X_train)), size=n_samples)
-        X_train = X_train[sample_idx]
+        sample_idx = rng.choice(len(X_train), size=n_samples, replace=False,
+                                shuffle=False)
+        # sorting the indices makes the gather near-sequential
+        sample_idx.sort()
+        X_train = np.ascontiguousarray(X_train[sample_idx])
         y_train = y_train[sample_idx]
 
     # scale and normalize the data
     if scale_x:
         print('scaling X')
-        sc_X = StandardScaler() 
+        sc_X = StandardScaler()
         X_train_scaled = sc_X.fit_transform(X_train)
         X_test_scaled = sc_X.transform(X_test)
     else:
@@ -64,24 +82,73 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
 
     if scale_y:
         print('scaling y')
-        sc_y = StandardScaler()
-        y_train_scaled = sc_y.fit_transform(y_train.reshape(-1,1)).flatten()
+        # the y "scaler" is just (y - mean)/std; computing it directly
+        # avoids sklearn's input validation and the reshape/flatten copies
+        y_mean = float(y_train.mean())
+        y_std = float(y_train.std())
+        if y_std == 0:
+            y_std = 1.0
+        y_train_scaled = (y_train - y_mean)/y_std
     else:
+        y_mean, y_std = 0.0, 1.0
         y_train_scaled = y_train
 
+    return (X_train_scaled, X_test_scaled, y_train, y_test, y_train_scaled,
+            y_mean, y_std)
+
+def evaluate_model(dataset, results_path, random_state, est_name, est, 
+                   hyper_params, complexity, model, test=False, 
+                   target_noise=0.0, feature_noise=0.0, 
+                   n_samples=10000, scale_x = True, scale_y = True,
+                   pre_train=None, skip_tuning=False, sym_data=False,
+                   n_jobs=-1, dtype='f64'):
+
+    print(40*'=','Evaluating '+est_name+' on ',dataset,40*'=',sep='\n')
+
+    np.random.seed(random_state)
+    if hasattr(est, 'random_state'):
+        est.random_state = random_state
+
+    ##################################################
+    # setup data
+    ##################################################
+    if sym_data:
+        true_model = get_sym_model(dataset)
+
+    (X_train_scaled, X_test_scaled, y_train, y_test, y_train_scaled,
+     y_mean, y_std) = setup_data(dataset, random_state, n_samples, scale_x,
+                                 scale_y)
+
     # add noise to the target
+    rng = np.random.default_rng(random_state)
     if target_noise > 0:
         print('adding',target_noise,'noise to target')
-        y_train_scaled += np.random.normal(0, 
-                    target_noise*np.sqrt(np.mean(np.square(y_train_scaled))),
-                    size=len(y_train_scaled))
-    # add noise to the features
+        # single BLAS dot instead of squaring into a temporary and reducing
+        y_scale = np.sqrt(np.dot(y_train_scaled, y_train_scaled)
+                          / y_train_scaled.size)
+        y_train_scaled = (y_train_scaled
+                + rng.standard_normal(len(y_train_scaled))
+                  * (target_noise*y_scale))
+    # add noise to the features, scaled by the RMS of each column
     if feature_noise > 0:
-        print('adding',target_noise,'noise to features')
-        X_train_scaled = np.array([x 
-            + np.random.normal(0, feature_noise*np.sqrt(np.mean(np.square(x))),
-                               size=len(x))
-                                   for x in X_train_scaled.T]).T
+        print('adding',feature_noise,'noise to features')
+        # einsum fuses the square and column reduction into one pass
+        col_scale = np.sqrt(np.einsum('ij,ij->j', X_train_scaled,
+                                      X_train_scaled)
+                            / X_train_scaled.shape[0])
+        X_train_scaled = (X_train_scaled
+                + rng.standard_normal(X_train_scaled.shape)
+                  * (feature_noise*col_scale))
+
+    # optionally downcast the data to float32, halving memory bandwidth and
+    # doubling SIMD throughput for estimators that support it. y_test stays
+    # float64 for reporting.
+    if dtype == 'f32':
+        print('downcasting data to float32')
+        X_train_scaled = np.ascontiguousarray(X_train_scaled,
+                                              dtype=np.float32)
+        X_test_scaled = np.ascontiguousarray(X_test_scaled, dtype=np.float32)
+        y_train_scaled = y_train_scaled.astype(np.float32, copy=False)
 
     # run any method-specific pre_train routines
     if pre_train:
@@ -124,28 +191,58 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
     else:
         n_splits = 5
 
-    if skip_tuning:
+    # with an empty grid (e.g. test mode) there is nothing to tune, so fit
+    # the estimator directly instead of paying the halving-search
+    # bookkeeping for a single candidate
+    tune = not skip_tuning and len(hyper_params) > 0
+    if not tune:
         print('skipping tuning')
         grid_est = clone(est)
     else:
         cv = KFold(n_splits=n_splits, shuffle=True,random_state=random_state)
 
         grid_est = HalvingGridSearchCV(est,cv=cv, param_grid=hyper_params,
-                verbose=2, n_jobs=1, scoring='r2', error_score=0.0)
+                verbose=2, n_jobs=n_jobs, scoring='r2', error_score=0.0)
+        # the halving constructor doesn't expose pre_dispatch, but the
+        # BaseSearchCV fit path reads the attribute; capping it bounds the
+        # number of in-flight fits (and thus peak memory) under large n_jobs
+        grid_est.pre_dispatch = '2*n_jobs'
 
-    ################################################## 
+    ##################################################
     # Fit models
-    ################################################## 
+    ##################################################
+    # dump the training matrix to a memmap so the search workers share its
+    # pages read-only instead of each unpickling a private copy
+    if tune and n_jobs != 1:
+        tmp_dir = mkdtemp()
+        atexit.register(rmtree, tmp_dir, ignore_errors=True)
+        X_path = os.path.join(tmp_dir, 'X_train.mmap')
+        X_mmap = np.memmap(X_path, dtype=X_train_scaled.dtype, mode='w+',
+                           shape=X_train_scaled.shape)
+        X_mmap[:] = X_train_scaled[:]
+        X_mmap.flush()
+        X_train_scaled = np.memmap(X_path, dtype=X_mmap.dtype, mode='r',
+                                   shape=X_mmap.shape)
+
     print('training',grid_est)
+    print('threadpools:',threadpool_info())
     t0p = time.process_time()
     t0t = time.time()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        grid_est.fit(X_train_scaled, y_train_scaled)
+        if tune and n_jobs != 1:
+            # run the (fold, candidate) fits concurrently across cores,
+            # pinning BLAS to one thread per worker so the process pool and
+            # the BLAS pools don't oversubscribe the machine
+            with threadpool_limits(limits=1, user_api='blas'), \
+                    parallel_backend('loky', n_jobs=n_jobs):
+                grid_est.fit(X_train_scaled, y_train_scaled)
+        else:
+            grid_est.fit(X_train_scaled, y_train_scaled)
     process_time = time.process_time() - t0p
     time_time = time.time() - t0t
     print('Training time measures:',process_time, time_time)
-    best_est = grid_est if skip_tuning else grid_est.best_estimator_
+    best_est = grid_est.best_estimator_ if tune else grid_est
     # best_est = grid_est
     
     ##################################################
@@ -155,7 +252,8 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
     results = {
         'dataset':dataset_name,
         'algorithm':est_name,
-        'params':jsonify(best_est.get_params()),
+        'params':{k:v for k,v in best_est.get_params().items()
+                  if isinstance(v, SCALAR_TYPES)},
         'random_state':random_state,
         'process_time': process_time, 
         'time_time': time_time, 
@@ -167,7 +265,7 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
 
     # get the size of the final model
     if complexity == None:
-        results['model_size'] = int(features.shape[1])
+        results['model_size'] = int(X_train_scaled.shape[1])
     else:
         results['model_size'] = int(complexity(best_est))
 
@@ -180,21 +278,22 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
         else:
             results['symbolic_model'] = model(best_est)
 
-    # scores
-    pred = grid_est.predict
+    # scores. predict on the refit estimator directly, skipping the search
+    # wrapper's check_is_fitted/input re-validation on each call
+    pred = best_est.predict
 
     for fold, target, X in zip(['train','test'],
-                               [y_train, y_test], 
+                               [y_train, y_test],
                                [X_train_scaled, X_test_scaled]
                               ):
-        for score, scorer in [('mse',mean_squared_error),
-                              ('mae',mean_absolute_error),
-                              ('r2', r2_score)
-                             ]:
-            y_pred = np.asarray(pred(X)).reshape(-1,1)
-            if scale_y:
-                y_pred = sc_y.inverse_transform(y_pred)
-            results[score + '_' + fold] = scorer(target, y_pred) 
+        # predict once per fold; denormalization and metrics are fused
+        y_pred = np.asarray(pred(X), dtype=np.float64).ravel()
+        target = np.asarray(target, dtype=np.float64).ravel()
+        mse, mae, r2 = fused_scores(y_pred, target, y_mean, y_std,
+                                    target.mean())
+        results['mse_' + fold] = mse
+        results['mae_' + fold] = mae
+        results['r2_' + fold] = r2
     
     ##################################################
     # write to file
@@ -211,22 +310,39 @@ def evaluate_model(dataset, results_path, random_state, est_name, est,
 
     print('save_file:',save_file)
 
-    with open(save_file + '.json', 'w') as out:
-        json.dump(jsonify(results), out, indent=4)
+    # orjson serializes numpy types natively, so no jsonify traversal of the
+    # whole results dict is needed; anything exotic falls back to str
+    with open(save_file + '.json', 'wb') as out:
+        out.write(orjson.dumps(results,
+                  option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2,
+                  default=str))
 
-    # store CV detailed results
-    # turning off for now as I dont think we'll need this for our analysis
-    # cv_results = grid_est.cv_results_
-    # cv_results['random_state'] = random_state
-
-    # with open(save_file + '_cv_results.json', 'w') as out:
-    #     json.dump(jsonify(cv_results), out, indent=4)
+    # store CV detailed results. cv_results_ is a dict of equal-length
+    # columns, so parquet is a much smaller and faster fit than json
+    if tune:
+        cv_results = grid_est.cv_results_
+        # numeric columns only; the param_* object columns hold arbitrary
+        # grid values that parquet can't encode
+        df_cv = pd.DataFrame({k:np.asarray(v) for k,v in cv_results.items()
+                              if hasattr(v, '__len__')
+                              and not isinstance(v, str)
+                              and np.asarray(v).dtype != object})
+        df_cv['random_state'] = random_state
+        df_cv.to_parquet(save_file + '_cv_results.parquet',
+                         compression='zstd', index=False)
 
 ################################################################################
 # main entry point
 ################################################################################
 import argparse
 import importlib
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def load_algorithm(name):
+    """imports methods.<name>; cached so drivers calling in-process across
+    seeds don't re-initialize heavy SR backends each time"""
+    return importlib.import_module('methods.' + name)
 
 if __name__ == '__main__':
 
@@ -255,17 +371,19 @@ if __name__ == '__main__':
                         'to the target')
     parser.add_argument('-sym_data',action='store_true', dest='SYM_DATA', 
                        help='Use symbolic dataset settings')
-    parser.add_argument('-skip_tuning',action='store_true', dest='SKIP_TUNE', 
+    parser.add_argument('-skip_tuning',action='store_true', dest='SKIP_TUNE',
                         default=False, help='Dont tune the estimator')
+    parser.add_argument('-n_jobs',action='store',dest='N_JOBS',
+                        default=-1, type=int, help='Number of parallel jobs '
+                        'for hyperparameter tuning (-1 uses all cores)')
+    parser.add_argument('-dtype',action='store',dest='DTYPE',
+                        default='f64', type=str, choices=('f32','f64'),
+                        help='Floating point precision used for training')
 
     args = parser.parse_args()
     # import algorithm 
     print('import from','methods.'+args.ALG)
-    algorithm = importlib.__import__('methods.'+args.ALG,
-                                     globals(),
-                                     locals(),
-                                     ['*']
-                                    )
+    algorithm = load_algorithm(args.ALG)
 
     print('algorithm:',algorithm.est)
     if 'hyper_params' not in dir(algorithm):
@@ -290,4 +408,5 @@ if __name__ == '__main__':
                    algorithm.est, algorithm.hyper_params, algorithm.complexity,
                    algorithm.model, test = args.TEST, 
                    target_noise=args.Y_NOISE, feature_noise=args.X_NOISE,
+                   n_jobs=args.N_JOBS, dtype=args.DTYPE,
                    **eval_kwargs)
@@ -1,30 +1,44 @@
+from functools import singledispatch
 import numpy as np
 import pandas as pd
 
+# jsonify is dispatched on type via singledispatch: one C-level registry
+# lookup per value instead of walking an isinstance chain, which adds up
+# when converting large nested results dicts.
+
+@singledispatch
 def jsonify(d):
-    """recursively formats dicts for json serialization"""
-    if isinstance(d, list):
-        d_new = []
-        for v in d:
-            d_new.append(jsonify(v))
-        return d_new
-    elif isinstance(d, dict):
-        for k in d.keys():
-            d[k] = jsonify(d[k])
-    elif isinstance(d, np.ndarray):
-        return d.tolist()
-    elif d.__class__.__name__.startswith('int'):
-        return int(d)
-    elif d.__class__.__name__.startswith('float'):
-        return float(d)
-    elif isinstance(d, pd.DataFrame) or isinstance(d, pd.Series):
-        return d.values.tolist()
-    elif isinstance(d, bool):
-        return d
-    elif d == None:
+    """recursively formats values for json serialization"""
+    if d is None:
         return None
-    elif not isinstance(d, str):
-        print("WARNING: attempting to store ",d,"as a str for json")
-        return str(d)
+    print("WARNING: attempting to store ",d,"as a str for json")
+    return str(d)
+
+@jsonify.register(bool)
+@jsonify.register(int)
+@jsonify.register(float)
+@jsonify.register(str)
+def _jsonify_scalar(d):
     return d
 
+@jsonify.register(list)
+@jsonify.register(tuple)
+def _jsonify_list(d):
+    return [jsonify(v) for v in d]
+
+@jsonify.register(dict)
+def _jsonify_dict(d):
+    return {k: jsonify(v) for k, v in d.items()}
+
+@jsonify.register(np.generic)
+def _jsonify_np_scalar(d):
+    return d.item()
+
+@jsonify.register(np.ndarray)
+def _jsonify_np_array(d):
+    return d.tolist()
+
+@jsonify.register(pd.DataFrame)
+@jsonify.register(pd.Series)
+def _jsonify_pandas(d):
+    return d.values.tolist()